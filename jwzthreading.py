@@ -23,13 +23,20 @@ This code is under a BSD-style license; see the LICENSE file for details.
 
 """
 
+import gc
 import re
+import multiprocessing
+from array import array
 import urllib.request
 from collections import deque
 import json
 from pathlib import Path
 
-__all__ = ['Message', 'make_message', 'thread']
+__all__ = ['Message', 'make_message', 'thread', 'thread_parallel']
+
+# Mean number of messages per connected component under which
+# thread_parallel() falls back to thread()
+MIN_PARALLEL_THREAD = 20
 
 class Container:
     """Contains a tree of messages.
@@ -190,16 +197,12 @@ def prune_container(container):
         return [container]
 
 
-def thread (msglist):
+def build_id_table (msglist):
     """([Message]) : {string:Container}
 
-    The main threading function.  This takes a list of Message
-    objects, and returns a dictionary mapping subjects to Containers.
-    Containers are trees, with the .children attribute containing a
-    list of subtrees, so callers can then sort children by date or
-    poster or whatever.
+    Step 1 of the algorithm: links the messages into containers
+    following their references, and returns the Message-ID table.
     """
-
     id_table = {}
     for msg in msglist:
         # 1A
@@ -233,6 +236,22 @@ def thread (msglist):
         if prev is not None:
             prev.add_child(this_container)
 
+    return id_table
+
+
+def thread (msglist):
+    """([Message]) : {string:Container}
+
+    The main threading function.  This takes a list of Message
+    objects, and returns a dictionary mapping subjects to Containers.
+    Containers are trees, with the .children attribute containing a
+    list of subtrees, so callers can then sort children by date or
+    poster or whatever.
+    """
+
+    # 1. Link messages
+    id_table = build_id_table(msglist)
+
     # 2. Find root set
     root_set = [container for container in id_table.values()
                 if container.parent is None]
@@ -259,6 +278,14 @@ def thread (msglist):
     ##for ctr in root_set:
     ##     print_container(ctr)
 
+    return group_by_subject(root_set)
+
+
+def group_by_subject (root_set):
+    """([Container]) : {string:Container}
+
+    Step 5 of the algorithm: groups the pruned root set by subject.
+    """
     # 5. Group root set by subject
     subject_table = {}
     for container in root_set:
@@ -314,6 +341,209 @@ def thread (msglist):
 
     return subject_table
 
+
+def reference_components (msglist):
+    """([Message]) : [[int]]
+
+    Splits the messages into the connected components of the
+    Message-ID/References graph, merging the smaller component into
+    the larger one when a message links two of them.  Returns lists
+    of indices into msglist.  Messages of different components never
+    end up in the same tree before step 5.
+    """
+    component = {}
+    ids = []
+    members = []
+    get = component.get
+    for i, msg in enumerate(msglist):
+        comp = get(msg.message_id)
+        new_ids = [] if comp is not None else [msg.message_id]
+        for ref in msg.references:
+            c = get(ref)
+            if c is None:
+                new_ids.append(ref)
+            elif comp is None:
+                comp = c
+            elif c != comp:
+                if len(ids[c]) > len(ids[comp]):
+                    c, comp = comp, c
+                for msg_id in ids[c]:
+                    component[msg_id] = comp
+                ids[comp].extend(ids[c])
+                members[comp].extend(members[c])
+                ids[c] = members[c] = None
+        if comp is None:
+            comp = len(ids)
+            ids.append([])
+            members.append([])
+        for msg_id in new_ids:
+            component[msg_id] = comp
+        ids[comp].extend(new_ids)
+        members[comp].append(i)
+    return [m for m in members if m is not None]
+
+
+# Message-IDs and references of the messages being threaded, set in
+# each worker process by _init_worker()
+_chunk_input = None
+
+def _init_worker (message_ids, references):
+    global _chunk_input
+    _chunk_input = (message_ids, references)
+    # Keep the collector from walking the objects inherited from the
+    # parent process at every collection
+    gc.freeze()
+
+
+def _thread_chunk (chunk):
+    """Runs steps 1 to 4 over a chunk of whole components.
+
+    'chunk' is a sorted list of message indices.  Returns the pruned
+    trees as flat arrays, in preorder: the message index of each node
+    (-1 for dummies), the position of its parent (-1 for roots), and
+    a {position: Message-ID} dictionary for the containers created for
+    a reference.  'roots' has one (position, count) pair per root
+    before pruning, 'count' being the number of trees replacing it and
+    'position' the (index, offset) where its Message-ID first appears,
+    which is its place in the id_table of thread().
+    """
+    message_ids, references = _chunk_input
+    msglist = []
+    for index in chunk:
+        msg = Message(index)
+        msg.message_id = message_ids[index]
+        msg.references = references[index]
+        msglist.append(msg)
+
+    id_table = build_id_table(msglist)
+    # Find the root set before pruning, which detaches promoted children
+    root_set = [(key, container) for key, container in id_table.items()
+                if container.parent is None]
+    del id_table
+
+    pending = set(key for key, container in root_set)
+    first_seen = {}
+    for msg in msglist:
+        if not pending:
+            break
+        if msg.message_id in pending:
+            first_seen[msg.message_id] = (msg.message, 0)
+            pending.discard(msg.message_id)
+        for offset, ref in enumerate(msg.references, 1):
+            if ref in pending:
+                first_seen[ref] = (msg.message, offset)
+                pending.discard(ref)
+
+    roots = []
+    nodes = array('l')
+    parents = array('l')
+    ref_ids = {}
+    for key, container in root_set:
+        trees = prune_container(container)
+        roots.append((first_seen[key], len(trees)))
+        stack = [(ctr, -1) for ctr in reversed(trees)]
+        while stack:
+            ctr, parent = stack.pop()
+            if hasattr(ctr, 'message_id'):
+                ref_ids[len(nodes)] = ctr.message_id
+            parents.append(parent)
+            parent = len(nodes)
+            nodes.append(-1 if ctr.message is None else ctr.message.message)
+            for child in reversed(ctr.children):
+                stack.append((child, parent))
+    return roots, nodes, parents, ref_ids
+
+
+def _link_chunk (result, msglist):
+    """Rebuilds the trees returned by _thread_chunk() around the
+    Message objects of msglist.  Returns a list of (position, [trees])
+    pairs, one per root before pruning.
+    """
+    roots, nodes, parents, ref_ids = result
+    containers = []
+    trees = []
+    for index, parent in zip(nodes, parents):
+        ctr = Container()
+        if index >= 0:
+            ctr.message = msglist[index]
+        if parent >= 0:
+            parent = containers[parent]
+            parent.children.append(ctr)
+            ctr.parent = parent
+        else:
+            trees.append(ctr)
+        containers.append(ctr)
+    for pos, message_id in ref_ids.items():
+        containers[pos].message_id = message_id
+
+    grouped = []
+    start = 0
+    for position, count in roots:
+        grouped.append((position, trees[start:start + count]))
+        start += count
+    return grouped
+
+
+def thread_parallel (msglist, processes=None):
+    """([Message], int) : {string:Container}
+
+    Same as thread(), but runs steps 1 to 4 over the connected
+    components of the reference graph in a pool of 'processes' worker
+    processes (by default one per CPU).  The returned dictionary is
+    identical to the one thread() would return.
+
+    Splitting the components and linking the returned trees stays
+    serial, so this only pays off when linking the references is
+    costly, ie: on large archives with long threads.  Otherwise, or
+    with a single process, this falls back to thread().
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1:
+        return thread(msglist)
+
+    components = reference_components(msglist)
+    if len(msglist) < MIN_PARALLEL_THREAD * len(components):
+        return thread(msglist)
+
+    # Pack the components into a few chunks per worker
+    chunk_size = max(1, len(msglist) // (processes * 4))
+    chunks = []
+    chunk = []
+    for component in components:
+        chunk.extend(component)
+        if len(chunk) >= chunk_size:
+            chunks.append(sorted(chunk))
+            chunk = []
+    if chunk:
+        chunks.append(sorted(chunk))
+    if len(chunks) == 1:
+        return thread(msglist)
+
+    initargs = ([msg.message_id for msg in msglist],
+                [msg.references for msg in msglist])
+    with multiprocessing.Pool(processes, _init_worker, initargs) as pool:
+        results = pool.map(_thread_chunk, chunks, chunksize=1)
+
+    # Linking allocates a container per node, all of them still
+    # referenced, which would only trigger useless collections
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        grouped = []
+        for result in results:
+            grouped.extend(_link_chunk(result, msglist))
+    finally:
+        if enabled:
+            gc.enable()
+
+    # Restore the order of the root set of thread()
+    grouped.sort(key=lambda root: root[0])
+    root_set = []
+    for position, trees in grouped:
+        root_set.extend(trees)
+
+    return group_by_subject(root_set)
+
 #messages = {}
 #msg = []
 def msg_ids(ctr, message_list = [], depth=0, debug=0):
@@ -353,10 +583,11 @@ def print_container(ctr, f, depth=0, debug=0):
         print_container(c, f, depth+1)
 
 
-def message_details(filename,Outputfile):
+def message_details(filename,Outputfile, processes=1):
     """
     This function
     :param filename: name of the mbox file
+    :param processes: number of threading processes, None for one per CPU
     :return: dictionary with messages {'message id1':[list of threads]}
     """
     import mailbox
@@ -393,7 +624,7 @@ def message_details(filename,Outputfile):
 
     
     print('Threading...')
-    subject_table = thread(msglist)
+    subject_table = thread_parallel(msglist, processes)
 
     # Output
     L = subject_table.items()
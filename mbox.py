@@ -21,7 +21,7 @@ class MboxParser:
         )
         return mbox_parser.fetch()
 
-    def create_json(self, mbox_files, output_file, file=False):
+    def create_json(self, mbox_files, output_file, file=False, processes=1):
         percevalout = self.getmbox(mbox_files)
         message_id = ''
         for item in percevalout:
@@ -29,7 +29,7 @@ class MboxParser:
             if message_id not in msg_ids:
                 msg_ids.append(message_id)
                 msg_json.append(item)
-        messages = th.message_details(mbox_files, output_file)
+        messages = th.message_details(mbox_files, output_file, processes)
         with open(output_file,'a') as f:
             for key, value in messages.items():
                 for k in msg_json:
@@ -58,14 +58,26 @@ class MboxParser:
 
 
         
+def processes(value):
+    """
+    Number of threading processes given on the command line, 0 for
+    one per CPU.
+    """
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError('%s is not 0 or more' % value)
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--mbox",required=True,help="Give the name of the mbox file to be parsed")
     parser.add_argument("--output", required=True, help="Name of the output json file")
+    parser.add_argument("--processes", type=processes, default=1, help="Number of processes used for threading, 0 for one per CPU")
     args = parser.parse_args()
     logging.basicConfig(filename='perceval_mbox_parse.log', level=logging.DEBUG)
     mparser = MboxParser()
-    mparser.create_json(args.mbox,args.output)
+    mparser.create_json(args.mbox,args.output,processes=args.processes or None)
     print("Output file %s created"%args.output)
 
 if __name__ == "__main__":
@@ -9,8 +9,10 @@ import jwzthreading as th
 from jwzthreading import Container
 container = Container()
 
-from perceval.backends.core.mbox 
 import elasticsearch
+import elasticsearch.helpers
+
+from perceval_elasticparse import PARTITION_FORMAT, message_date, partition_index, partition_format, check_partition, create_partition
 
 import logging
 
@@ -26,18 +28,29 @@ es = elasticsearch.Elasticsearch(['http://localhost:9200/'])
 
 class ElasticThread:
 
-    def threading(self, oldindex, newindex,output_file, file=False):
+    def threading(self, oldindex, newindex,output_file, file=False, partition=PARTITION_FORMAT):
 
-        es.indices.create(newindex)
-        res = es.search(index=oldindex)
+        check_partition(newindex, partition)
+        # Partitions of newindex already checked during this run
+        created = set()
 
-        print("%d documents found" % res['hits']['total'])
-        for doc in res['hits']['hits']:
+        print("%d documents found" % es.count(index=oldindex)['count'])
+        # Scroll through every document, a search only returns the first hits
+        for doc in elasticsearch.helpers.scan(es, index=oldindex):
             #print("%s) %s" % (doc['_id'], doc['_source'])
             #message_id = doc['data']['Message-ID']
             with open(output_file,'a') as f:
                 json.dump(doc, f, ensure_ascii=True, indent=4)
 
+            # Route the document to the partition of its message date
+            source = doc['_source']
+            partition_name = partition_index(newindex, message_date(source.get('data', source)), partition)
+            if partition_name not in created:
+                create_partition(newindex, partition_name, partition)
+                created.add(partition_name)
+            # Keep the document id, so copying again overwrites it
+            es.index(index=partition_name, doc_type='summary', id=doc['_id'], body=source)
+
         messages = th.message_details(output_file, file=True)
         #es.index(index='thm', doc_type='summary', body=summary)
 
@@ -47,12 +60,13 @@ class ElasticThread:
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--oldindex",required=True,help="Give the name of the index to be searched")
-    parser.add_argument("--newindex", required=True, help="Name of the Elasticsearch index to be created")
+    parser.add_argument("--newindex", required=True, help="Name of the Elasticsearch alias to be created over the partition indices")
     parser.add_argument("--output_file",required=True,help="Give the name of the index to be searched")
+    parser.add_argument("--partition", type=partition_format, default=PARTITION_FORMAT, help="strftime format naming the partition indices, a day or coarser (default: %(default)s, one per month)")
     args = parser.parse_args()
     logging.basicConfig(filename='perceval_mbox_parse.log', level=logging.DEBUG)
     mparser = ElasticThread()
-    mparser.threading(args.oldindex, args.newindex, args.output_file)
+    mparser.threading(args.oldindex, args.newindex, args.output_file, partition=args.partition)
 
 if __name__ == "__main__":
     main()
@@ -2,27 +2,207 @@
 import logging
 import argparse
 import json
+import re
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import elasticsearch
 
 msg_ids = []
 msg_json = []
 
+# Default strftime format used to name the partitions (one index per month)
+PARTITION_FORMAT = '%Y.%m'
+# Numeric strftime directives allowed in partition formats (a day or
+# coarser), with the width of the number they render
+DATE_DIRECTIVES = {'Y': 4, 'G': 4, 'm': 2, 'd': 2, 'j': 3,
+                   'U': 2, 'W': 2, 'V': 2, 'u': 1}
+
 
 # ElasticSearch instance (url)
 es = elasticsearch.Elasticsearch(['http://localhost:9200/'])
 
 
+def message_date(data):
+    """
+    Returns the date of a message as an UTC datetime, or None when
+    the Date header is missing or cannot be parsed.
+
+    :param data: 'data' dictionary of a perceval item, or an indexed
+        summary whose Date is already in ISO format
+    """
+    try:
+        date = parsedate_to_datetime(data['Date'])
+    except (KeyError, TypeError, ValueError):
+        try:
+            date = datetime.fromisoformat(data['Date'])
+        except (KeyError, TypeError, ValueError):
+            return None
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date.astimezone(timezone.utc)
+
+
+def partition_index(indexname, date, partition=PARTITION_FORMAT):
+    """
+    Returns the name of the partition alias holding messages sent
+    at 'date', eg: mboxes-2016.05 for the 'mboxes' alias.
+
+    :param indexname: name of the read alias
+    :param date: datetime of the message, may be None
+    :param partition: strftime format naming the partitions
+    """
+    if date is None:
+        return '%s-undated' % indexname
+    return '%s-%s' % (indexname, date.strftime(partition))
+
+
+def partition_format(value):
+    """
+    Checks a strftime format naming the partitions.  Only numeric
+    dates of a day or coarser are allowed, and the names must be valid
+    index names that sort in time order, as search.py selects the
+    partitions of a date range by comparing their names.
+
+    :param value: strftime format, eg: %Y.%m
+    """
+    for directive in re.findall('%(.)', value):
+        if directive not in DATE_DIRECTIVES:
+            raise argparse.ArgumentTypeError('%%%s is not a numeric date of a day or coarser' % directive)
+    names = []
+    day = date(1999, 1, 1)
+    while day < date(2041, 1, 1):
+        names.append(day.strftime(value))
+        day += timedelta(days=1)
+    if not re.fullmatch('[a-z0-9._-]+', names[0]):
+        raise argparse.ArgumentTypeError('%s gives %s, not a valid index name' % (value, names[0]))
+    if names != sorted(names) or names[0] == names[-1]:
+        raise argparse.ArgumentTypeError('%s does not split the messages by time' % value)
+    return value
+
+
+def partition_pattern(partition):
+    """
+    Returns a regular expression matching the partition names (without
+    the read alias) rendered by the format 'partition'.
+    """
+    pattern = ''
+    for text, directive in re.findall('([^%]*)(?:%(.))?', partition):
+        pattern += re.escape(text)
+        if directive:
+            pattern += '[0-9]{%d}' % DATE_DIRECTIVES[directive]
+    return re.compile(pattern)
+
+
+def stored_partition(indexname):
+    """
+    Returns the partition format the partitions of 'indexname' were
+    loaded with, or None when there are no partitions yet.
+    """
+    if not es.indices.exists_alias(name=indexname):
+        return None
+    formats = set()
+    for index in es.indices.get_mapping(index=indexname).values():
+        for mapping in index['mappings'].values():
+            formats.add(mapping.get('_meta', {}).get('partition'))
+    if len(formats) != 1 or None in formats:
+        print('%s mixes partition formats %s, rebuild it before running this script again.' % (indexname, sorted(map(str, formats))))
+        exit()
+    return formats.pop()
+
+
+def check_partition(indexname, partition):
+    """
+    Exits when 'indexname' was loaded with another partition format.
+    """
+    stored = stored_partition(indexname)
+    if stored is not None and stored != partition:
+        print('%s is partitioned with --partition %s, not %s.' % (indexname, stored, partition))
+        exit()
+
+
+def check_alias(name):
+    """
+    Exits when 'name' is a plain index, where an alias is expected.
+    """
+    if es.indices.exists(index=name) and not es.indices.exists_alias(name=name):
+        print('%s is an index, not an alias, remove it before running this script again.' % name)
+        exit()
+
+
+def new_partition(partition_name, partition, aliases=()):
+    """
+    Creates a new version of a partition index, named after the
+    partition and the current time, and returns its name.  The
+    partition format is kept in the mapping, for search.py.
+
+    :param partition_name: name of the partition alias
+    :param partition: strftime format naming the partitions
+    :param aliases: aliases pointing to the new index
+    """
+    version = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')
+    index = '%s-v%s' % (partition_name, version)
+    es.indices.create(index=index, body={
+        'aliases': {alias: {} for alias in aliases},
+        'mappings': {'summary': {'_meta': {'partition': partition}}}})
+    return index
+
+
+def create_partition(indexname, partition_name, partition=PARTITION_FORMAT):
+    """
+    Creates a partition index, if it does not exist yet, reachable
+    through the read alias and through its own partition alias.
+    Existing partitions are kept as they are.
+
+    :param indexname: name of the read alias
+    :param partition_name: name of the partition alias
+    :param partition: strftime format naming the partitions
+    """
+    check_alias(indexname)
+    check_alias(partition_name)
+    if not es.indices.exists_alias(name=partition_name):
+        new_partition(partition_name, partition, (indexname, partition_name))
+
+
+def swap_partition(indexname, partition_name, index):
+    """
+    Points the read alias and the partition alias to 'index' in one
+    atomic call, then deletes the previous versions of the partition.
+
+    :param indexname: name of the read alias
+    :param partition_name: name of the partition alias
+    :param index: rebuilt index, created by new_partition()
+    """
+    check_alias(indexname)
+    check_alias(partition_name)
+    old = []
+    if es.indices.exists_alias(name=partition_name):
+        old = list(es.indices.get_alias(name=partition_name))
+    actions = [{'remove': {'index': o, 'alias': alias}}
+               for o in old for alias in (indexname, partition_name)]
+    actions += [{'add': {'index': index, 'alias': alias}}
+                for alias in (indexname, partition_name)]
+    es.indices.update_aliases(body={'actions': actions})
+    for o in old:
+        es.indices.delete(index=o)
+
+
 # Create a mbox object, pointing to uri, using dir_path for fetching
 class MboxElastic:
 
-    def elastic(self, threaded_files, indexname):
-        try:
-            # Create the 'mboxes' index in ElasticSearch
-            es.indices.create(indexname)
-        except elasticsearch.exceptions.RequestError:
-            print('Index already exisits, remove it before running this script again.')
-            exit()
-        
+    def elastic(self, threaded_files, indexname, partition=PARTITION_FORMAT, rebuild=()):
+        """
+        Indexes the messages of threaded_files in their partitions,
+        using the Message-ID as document id so loading the same
+        messages again overwrites them.  The partitions named in
+        'rebuild' (eg: 2016.05) are instead built from this file only
+        in a new index, which replaces the stored one once complete.
+        """
+        check_partition(indexname, partition)
+        rebuild = {'%s-%s' % (indexname, name) for name in rebuild}
+        # New indices of the partitions being rebuilt
+        rebuilt = {}
+        created = set()
+
         jfile = None
         with open(threaded_files) as f:
             for line in f:
@@ -31,30 +211,53 @@ class MboxElastic:
                         jfile = json.loads(line, strict=False)
                         # Create the object (dictionary) to upload to ElasticSearch
                         for j in jfile:
+                            date = message_date(jfile['data'])
                             summary = {'message': jfile['data']['Message-ID'],
                        'Sender': jfile['data']['X-Env-Sender'],
-                       'From' : jfile['data']['From']
+                       'From' : jfile['data']['From'],
+                       'Date' : date.isoformat() if date else None
                        }
                         break
                     except ValueError:
                         # Not yet a complete JSON value
                         line += next(f)
 
+                partition_name = partition_index(indexname, date, partition)
+                if partition_name in rebuild:
+                    if partition_name not in rebuilt:
+                        rebuilt[partition_name] = new_partition(partition_name, partition)
+                    target = rebuilt[partition_name]
+                else:
+                    if partition_name not in created:
+                        create_partition(indexname, partition_name, partition)
+                        created.add(partition_name)
+                    target = partition_name
                 # Upload the object to ElasticSearch
-                es.index(index=indexname, doc_type='summary', body=summary)
+                es.index(index=target, doc_type='summary', id=summary['message'], body=summary)
             f.close()
-                
-                
+
+        for partition_name in sorted(rebuild):
+            if partition_name not in rebuilt:
+                rebuilt[partition_name] = new_partition(partition_name, partition)
+            swap_partition(indexname, partition_name, rebuilt[partition_name])
+            logging.debug('Rebuilt %s in %s', partition_name, rebuilt[partition_name])
+
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--filename",required=True,help="Give the name of the threaded file")
-    parser.add_argument("--indexname", required=True, help="Name of the Elasticsearch index")
+    parser.add_argument("--indexname", required=True, help="Name of the Elasticsearch alias over the partition indices")
+    parser.add_argument("--partition", type=partition_format, default=PARTITION_FORMAT, help="strftime format naming the partition indices, a day or coarser (default: %(default)s, one per month)")
+    parser.add_argument("--rebuild", action='append', default=[], metavar="PARTITION", help="Replace this partition (eg: 2016.05, or undated) with the messages of the file only, can be repeated")
     args = parser.parse_args()
+    pattern = partition_pattern(args.partition)
+    for name in args.rebuild:
+        if name != 'undated' and not pattern.fullmatch(name):
+            parser.error("--rebuild %s is not a partition of --partition %s" % (name, args.partition))
     logging.basicConfig(filename='perceval_mbox_parse.log', level=logging.DEBUG)
     mparser = MboxElastic()
-    mparser.elastic(args.filename,args.indexname)
+    mparser.elastic(args.filename,args.indexname,args.partition,args.rebuild)
 
 if __name__ == "__main__":
     main()
-
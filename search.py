@@ -2,18 +2,72 @@
 import logging
 import argparse
 import json
+from datetime import datetime, timedelta
 import elasticsearch
 
+from perceval_elasticparse import partition_index, partition_pattern, stored_partition
+
 
 es = elasticsearch.Elasticsearch(['http://localhost:9200/'])
 
 
+def partition_indices(names, indexname, since, until, partition):
+	"""
+	Returns the partition aliases, among 'names', holding messages
+	sent from 'since' to 'until' (both included, either may be None),
+	so that only they are searched.  Partition names sort in time
+	order, see partition_format().
+
+	:param names: existing partition aliases
+	:param indexname: name of the read alias
+	:param since: first day, datetime.date or None
+	:param until: last day, datetime.date or None
+	:param partition: strftime format naming the partitions
+	"""
+	pattern = partition_pattern(partition)
+	prefix = '%s-' % indexname
+	low = since and partition_index(indexname, since, partition)[len(prefix):]
+	high = until and partition_index(indexname, until, partition)[len(prefix):]
+	indices = set()
+	for name in names:
+		suffix = name[len(prefix):]
+		if not name.startswith(prefix) or not pattern.fullmatch(suffix):
+			continue
+		if (low is None or suffix >= low) and (high is None or suffix <= high):
+			indices.add(name)
+	return sorted(indices)
+
+
 class Search:
 
-	def query(self, field, result, indexname):
+	def query(self, field, result, indexname, since=None, until=None):
+		body = {"query": {"match": {field : result}}}
+		index = indexname
+		if since or until:
+			date_range = {}
+			if since:
+				date_range["gte"] = since.isoformat()
+			if until:
+				date_range["lt"] = (until + timedelta(days=1)).isoformat()
+			body = {"query": {"bool": {"must": {"match": {field : result}},
+					"filter": {"range": {"Date": date_range}}}}}
+
+			# Only the partitions within the range are searched, using
+			# the partition format the messages were loaded with
+			partition = stored_partition(indexname)
+			if partition is None:
+				print("%s has no partitions, load messages before searching." % indexname)
+				return
+			names = [alias for aliases in es.indices.get_alias(name='%s-*' % indexname).values()
+				for alias in aliases['aliases']]
+			indices = partition_indices(names, indexname, since, until, partition)
+			if not indices:
+				print("Found 0 messages")
+				return
+			index = ','.join(indices)
+
 		#search for the particular field and value
-		es_result = es.search(index=indexname, doc_type='summary',
-                    body={"query": {"match": {field : result}}})
+		es_result = es.search(index=index, doc_type='summary', body=body)
 
 		print("Found %d messages" % es_result['hits']['total'])
 		# Print number of messages retrieved
@@ -22,16 +76,23 @@ class Search:
         (message['_source']['Sender'], message['_source']['From'], message['_source']['message']))
 
 
+def day(value):
+	return datetime.strptime(value, '%Y-%m-%d').date()
+
 
 def main():
  	parser = argparse.ArgumentParser()
  	parser.add_argument("--field",required=True,help="Give the name of the field")
  	parser.add_argument("--result",required=True,help="Give the data to be searched")
- 	parser.add_argument("--indexname", required=True, help="Name of the Elasticsearch index")
+ 	parser.add_argument("--indexname", required=True, help="Name of the Elasticsearch alias")
+ 	parser.add_argument("--since", type=day, help="Only search messages sent on or after this day (YYYY-MM-DD)")
+ 	parser.add_argument("--until", type=day, help="Only search messages sent on or before this day (YYYY-MM-DD)")
  	args = parser.parse_args()
+ 	if args.since and args.until and args.since > args.until:
+ 		parser.error("--since must not be later than --until")
  	logging.basicConfig(filename='perceval_mbox_parse.log', level=logging.DEBUG)
  	mparser = Search()
- 	mparser.query(args.field,args.result, args.indexname)
+ 	mparser.query(args.field,args.result, args.indexname, args.since, args.until)
 
 if __name__ == "__main__":
     main()
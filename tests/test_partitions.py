@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import unittest
+from datetime import date, datetime, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+	import elasticsearch
+except ImportError:
+	# The tests never reach a cluster, the client is patched below
+	sys.modules['elasticsearch'] = mock.MagicMock()
+import perceval_elasticparse as pe
+from perceval_elasticparse import message_date, partition_index, partition_format, partition_pattern
+from search import partition_indices
+
+
+def fake_es(aliases=(), partition='%Y.%m'):
+	"""
+	Returns a mocked client where the names in 'aliases' are aliases
+	of indices loaded with the 'partition' format.
+	"""
+	es = mock.MagicMock()
+	es.indices.exists.side_effect = lambda index: index in aliases
+	es.indices.exists_alias.side_effect = lambda name: name in aliases
+	es.indices.get_alias.side_effect = lambda name: {name + '-v1': {'aliases': {name: {}}}}
+	es.indices.get_mapping.return_value = {
+		'mboxes-2016.05-v1': {'mappings': {'summary': {'_meta': {'partition': partition}}}}}
+	return es
+
+
+class Test_Message_Date(unittest.TestCase):
+
+	def test_converted_to_utc(self):
+		"""
+		A message sent early on the 1st in a zone ahead of UTC
+		belongs to the previous month.
+		"""
+		d = message_date({'Date': 'Sun, 1 May 2016 01:30:00 +0200'})
+		self.assertEqual(d, datetime(2016, 4, 30, 23, 30, tzinfo=timezone.utc))
+		self.assertEqual(partition_index('mboxes', d), 'mboxes-2016.04')
+
+	def test_iso_date(self):
+		d = message_date({'Date': '2016-05-31T23:30:00+00:00'})
+		self.assertEqual(d, datetime(2016, 5, 31, 23, 30, tzinfo=timezone.utc))
+
+	def test_naive_date_is_utc(self):
+		d = message_date({'Date': '2016-05-31T23:30:00'})
+		self.assertEqual(d.tzinfo, timezone.utc)
+
+	def test_undated(self):
+		for data in ({}, {'Date': None}, {'Date': ''}, {'Date': 'not a date'}):
+			self.assertIsNone(message_date(data), data)
+		self.assertEqual(partition_index('mboxes', None), 'mboxes-undated')
+
+
+class Test_Partitions(unittest.TestCase):
+
+	names = ['mboxes-2016.04', 'mboxes-2016.05', 'mboxes-2016.06', 'mboxes-2017.01',
+		'mboxes-undated', 'mboxes-old', 'other-2016.05']
+
+	def test_partition_index(self):
+		d = datetime(2016, 5, 10, tzinfo=timezone.utc)
+		self.assertEqual(partition_index('mboxes', d), 'mboxes-2016.05')
+		self.assertEqual(partition_index('mboxes', d, '%Y'), 'mboxes-2016')
+		self.assertEqual(partition_index('mboxes', d, '%Y.%m.%d'), 'mboxes-2016.05.10')
+
+	def test_partition_indices(self):
+		self.assertEqual(partition_indices(self.names, 'mboxes', date(2016, 4, 20), date(2016, 6, 2), '%Y.%m'),
+			['mboxes-2016.04', 'mboxes-2016.05', 'mboxes-2016.06'])
+		self.assertEqual(partition_indices(self.names, 'mboxes', date(2016, 5, 3), date(2016, 5, 3), '%Y.%m'),
+			['mboxes-2016.05'])
+		self.assertEqual(partition_indices(['mboxes-2016', 'mboxes-2017'], 'mboxes', date(2016, 12, 30), date(2017, 1, 2), '%Y'),
+			['mboxes-2016', 'mboxes-2017'])
+
+	def test_open_ranges(self):
+		"""
+		--since alone keeps the later partitions, even in the future,
+		and --until alone keeps the earlier ones.
+		"""
+		self.assertEqual(partition_indices(self.names, 'mboxes', date(2016, 6, 1), None, '%Y.%m'),
+			['mboxes-2016.06', 'mboxes-2017.01'])
+		self.assertEqual(partition_indices(self.names, 'mboxes', None, date(2016, 5, 31), '%Y.%m'),
+			['mboxes-2016.04', 'mboxes-2016.05'])
+
+	def test_reversed_range(self):
+		self.assertEqual(partition_indices(self.names, 'mboxes', date(2016, 6, 1), date(2016, 5, 1), '%Y.%m'), [])
+
+	def test_partition_format(self):
+		for value in ('%Y.%m', '%Y', '%Y.%m.%d', '%G.%V', '%G.%V.%u', '%Y.%j', '%Y-w%W'):
+			self.assertEqual(partition_format(value), value)
+		for value in ('%Y.%m.%d.%H', '%Y%M', '%s', '%Y%%',
+				# Not valid index names
+				'%b', '%a', '%Y %B', '%Y %m', 'X%Y',
+				# Repeat every year or week
+				'%m', '%d', '%a', '%A', '%w', '%j', '%U', '%W', '%y', '%Y.%d', '%Y.%V',
+				# Not in time order
+				'%m.%Y', 'mboxes'):
+			self.assertRaises(argparse.ArgumentTypeError, partition_format, value)
+
+	def test_partition_pattern(self):
+		self.assertTrue(partition_pattern('%Y.%m').fullmatch('2016.05'))
+		self.assertFalse(partition_pattern('%Y').fullmatch('2016.05'))
+		self.assertFalse(partition_pattern('%Y.%m').fullmatch('2016-05'))
+		self.assertTrue(partition_pattern('%G-w%V').fullmatch('2016-w18'))
+
+
+class Test_Elastic(unittest.TestCase):
+
+	def test_create_partition(self):
+		es = fake_es()
+		with mock.patch.object(pe, 'es', es):
+			pe.create_partition('mboxes', 'mboxes-2016.05', '%Y.%m')
+		kwargs = es.indices.create.call_args[1]
+		self.assertTrue(kwargs['index'].startswith('mboxes-2016.05-v'))
+		self.assertEqual(kwargs['body']['aliases'], {'mboxes': {}, 'mboxes-2016.05': {}})
+		self.assertEqual(kwargs['body']['mappings'], {'summary': {'_meta': {'partition': '%Y.%m'}}})
+
+	def test_existing_partition_is_kept(self):
+		es = fake_es(('mboxes', 'mboxes-2016.05'))
+		with mock.patch.object(pe, 'es', es):
+			pe.create_partition('mboxes', 'mboxes-2016.05', '%Y.%m')
+		es.indices.create.assert_not_called()
+		es.indices.delete.assert_not_called()
+
+	def test_plain_index(self):
+		es = fake_es()
+		es.indices.exists.side_effect = lambda index: index == 'mboxes'
+		with mock.patch.object(pe, 'es', es):
+			self.assertRaises(SystemExit, pe.create_partition, 'mboxes', 'mboxes-2016.05', '%Y.%m')
+		es.indices.create.assert_not_called()
+
+	def test_swap_partition(self):
+		"""
+		Both aliases move to the new index in one call, and the old
+		version is deleted only afterwards.
+		"""
+		es = fake_es(('mboxes', 'mboxes-2016.05'))
+		with mock.patch.object(pe, 'es', es):
+			pe.swap_partition('mboxes', 'mboxes-2016.05', 'mboxes-2016.05-v2')
+		calls = [c for c in es.indices.mock_calls if c[0] in ('update_aliases', 'delete')]
+		self.assertEqual(calls, [
+			mock.call.update_aliases(body={'actions': [
+				{'remove': {'index': 'mboxes-2016.05-v1', 'alias': 'mboxes'}},
+				{'remove': {'index': 'mboxes-2016.05-v1', 'alias': 'mboxes-2016.05'}},
+				{'add': {'index': 'mboxes-2016.05-v2', 'alias': 'mboxes'}},
+				{'add': {'index': 'mboxes-2016.05-v2', 'alias': 'mboxes-2016.05'}}]}),
+			mock.call.delete(index='mboxes-2016.05-v1')])
+
+	def write_messages(self, dates):
+		f = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+		self.addCleanup(os.remove, f.name)
+		for n, d in enumerate(dates):
+			json.dump({'data': {'Message-ID': '<%d@example.org>' % n, 'X-Env-Sender': 'a@example.org',
+				'From': 'A <a@example.org>', 'Date': d}}, f, indent=4)
+			f.write('\n')
+		f.close()
+		return f.name
+
+	def test_elastic(self):
+		"""
+		Messages are indexed under their Message-ID in their partition
+		alias, and existing partitions are never deleted.
+		"""
+		filename = self.write_messages(['Sun, 1 May 2016 01:30:00 +0200', 'Tue, 10 May 2016 10:00:00 +0000', 'garbage'])
+		es = fake_es(('mboxes', 'mboxes-2016.04', 'mboxes-2016.05'))
+		with mock.patch.object(pe, 'es', es):
+			pe.MboxElastic().elastic(filename, 'mboxes')
+		self.assertEqual([(c[1]['index'], c[1]['id']) for c in es.index.call_args_list],
+			[('mboxes-2016.04', '<0@example.org>'), ('mboxes-2016.05', '<1@example.org>'), ('mboxes-undated', '<2@example.org>')])
+		self.assertEqual([c[1]['index'].rsplit('-v', 1)[0] for c in es.indices.create.call_args_list], ['mboxes-undated'])
+		es.indices.delete.assert_not_called()
+		es.indices.update_aliases.assert_not_called()
+
+	def test_elastic_rebuild(self):
+		"""
+		Rebuilt partitions are filled in new indices, swapped in once
+		the file is loaded, including those absent from the file.
+		"""
+		filename = self.write_messages(['Sun, 1 May 2016 01:30:00 +0200', 'Tue, 10 May 2016 10:00:00 +0000'])
+		es = fake_es(('mboxes', 'mboxes-2016.04', 'mboxes-2016.05', 'mboxes-2016.06'))
+		with mock.patch.object(pe, 'es', es):
+			pe.MboxElastic().elastic(filename, 'mboxes', rebuild=['2016.05', '2016.06'])
+		created = [c[1]['index'] for c in es.indices.create.call_args_list]
+		self.assertEqual([c.rsplit('-v', 1)[0] for c in created], ['mboxes-2016.05', 'mboxes-2016.06'])
+		self.assertEqual([c[1]['body']['aliases'] for c in es.indices.create.call_args_list], [{}, {}])
+		self.assertEqual([(c[1]['index'], c[1]['id']) for c in es.index.call_args_list],
+			[('mboxes-2016.04', '<0@example.org>'), (created[0], '<1@example.org>')])
+
+		names = [c[0] for c in es.mock_calls if c[0] in ('index', 'indices.update_aliases', 'indices.delete')]
+		self.assertEqual(names, ['index', 'index',
+			'indices.update_aliases', 'indices.delete', 'indices.update_aliases', 'indices.delete'])
+		self.assertEqual([c[1]['index'] for c in es.indices.delete.call_args_list],
+			['mboxes-2016.05-v1', 'mboxes-2016.06-v1'])
+
+	def test_other_partition_format(self):
+		filename = self.write_messages(['Tue, 10 May 2016 10:00:00 +0000'])
+		es = fake_es(('mboxes', 'mboxes-2016.05'), partition='%Y.%m')
+		with mock.patch.object(pe, 'es', es):
+			self.assertRaises(SystemExit, pe.MboxElastic().elastic, filename, 'mboxes', '%Y')
+		es.index.assert_not_called()
+
+if __name__ == '__main__':
+	unittest.main()
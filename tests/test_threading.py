@@ -0,0 +1,102 @@
+import os
+import random
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jwzthreading as th
+
+
+def random_messages(seed, threads=60):
+	"""
+	Builds threads of messages with missing parents, duplicate
+	Message-IDs, reference cycles, links between threads and IDs
+	rewritten by the subject stripping of step 5.
+	"""
+	rnd = random.Random(seed)
+	msglist = []
+	for t in range(threads):
+		ids = []
+		for i in range(rnd.randrange(1, 25)):
+			msg = th.Message(len(msglist))
+			prefix = rnd.choice(['', '', '', 'Re: ', '[Xen-devel] '])
+			msg.message_id = '%s%d.%d@example.org' % (prefix, t, i)
+			if ids and rnd.random() < 0.05:
+				# Duplicate Message-ID
+				msg.message_id = rnd.choice(ids)
+			refs = []
+			if ids and rnd.random() < 0.9:
+				parent = rnd.randrange(len(ids))
+				refs = ids[max(0, parent - rnd.randrange(4)):parent + 1]
+			if rnd.random() < 0.1:
+				# Missing parent
+				refs.insert(0, 'missing.%d.%d@example.org' % (t, rnd.randrange(3)))
+			if ids and rnd.random() < 0.03:
+				# Cycle through a later message
+				refs.append('%d.%d@example.org' % (t, i + 1))
+			if msglist and rnd.random() < 0.01:
+				# Link to another thread
+				refs.append(rnd.choice(msglist).message_id)
+			msg.references = th.uniq(refs)
+			ids.append(msg.message_id)
+			msglist.append(msg)
+	rnd.shuffle(msglist)
+	return msglist
+
+
+def walk(subject_table):
+	"""
+	Lists the subject table node by node, with the depth, message
+	and Message-ID attribute of each container.
+	"""
+	nodes = []
+	for subject, ctr in subject_table.items():
+		stack = [(ctr, 0)]
+		while stack:
+			ctr, depth = stack.pop()
+			nodes.append((subject, depth, ctr.message, getattr(ctr, 'message_id', None), len(ctr.children)))
+			for child in reversed(ctr.children):
+				assert child.parent is ctr
+				stack.append((child, depth + 1))
+	return nodes
+
+
+class Test_Thread_Parallel(unittest.TestCase):
+
+	def test_reference_components(self):
+		msglist = random_messages(0)
+		components = th.reference_components(msglist)
+		self.assertEqual(sorted(i for c in components for i in c), list(range(len(msglist))))
+		component = {}
+		for n, c in enumerate(components):
+			for i in c:
+				component[msglist[i].message_id] = n
+		for n, c in enumerate(components):
+			for i in c:
+				for ref in msglist[i].references:
+					self.assertEqual(component.get(ref, n), n)
+
+	def test_identical_to_thread(self):
+		"""
+		thread_parallel() returns the same subject table as thread(),
+		node by node, around the same Message objects.
+		"""
+		for seed in range(30):
+			msglist = random_messages(seed)
+			expected = walk(th.thread(msglist))
+			# Run the process pool even on small archives, and fail
+			# if thread_parallel() falls back to thread()
+			with mock.patch.object(th, 'MIN_PARALLEL_THREAD', 0), \
+			     mock.patch.object(th, 'thread', side_effect=AssertionError('fallback')):
+				result = walk(th.thread_parallel(msglist, processes=3))
+			self.assertEqual(expected, result, 'seed %d' % seed)
+
+	def test_fallback(self):
+		msglist = random_messages(0)
+		with mock.patch.object(th, 'thread', wraps=th.thread) as thread:
+			th.thread_parallel(msglist, processes=1)
+			self.assertEqual(thread.call_count, 1)
+
+if __name__ == '__main__':
+	unittest.main()